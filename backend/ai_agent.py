@@ -1,9 +1,20 @@
 """AI Agent for intelligent notebook debugging and cell fixing."""
+import asyncio
+import concurrent.futures
+import hashlib
+import json
 import logging
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Dict, Any, Optional
+import httpx
+import orjson
 import google.generativeai as genai
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError
 from config import config
+from cell_tools import CellTool
 
 logger = logging.getLogger(__name__)
 
@@ -11,31 +22,413 @@ logger = logging.getLogger(__name__)
 if config.GEMINI_API_KEY:
     genai.configure(api_key=config.GEMINI_API_KEY)
 
-# Configure OpenAI
+# Dedicated pool for blocking Gemini SDK calls. The default executor is sized
+# for CPU work (min(32, cpus+4)) and shared with everything else in the
+# process; network-bound LLM calls get their own wider pool instead.
+_GEMINI_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=64, thread_name_prefix="gemini"
+)
+
+# Configure OpenAI. The SDK is handed an explicitly tuned httpx client so
+# bursty concurrent agent traffic reuses keep-alive connections (and HTTP/2
+# multiplexing) instead of paying a TCP+TLS handshake per request.
+_http_client = None
 openai_client = None
 if config.OPENAI_API_KEY:
-    openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+    _http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    )
+    openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, http_client=_http_client)
+
+
+async def aclose_http_client():
+    """Close the shared HTTP client; called from the app shutdown hook."""
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
+class _SemanticCache:
+    """
+    Response cache for repeated or near-identical prompts.
+
+    Two layers: an exact-match table on the full prompt digest (free, catches
+    straight retries without any network call), and an embedding layer that
+    returns a cached response when cosine similarity to a prior prompt
+    exceeds the configured threshold - users retrying the same traceback
+    with trivial wording changes hit this instead of the LLM.
+
+    Only the part of the prompt that actually varies between calls (the
+    user tail: task, traceback) is embedded, and candidates are compared
+    within a scope derived from the invariant part (model + system prompt).
+    Embedding the whole prompt would let the rendered notebook context
+    dominate the vector, making two different errors in the same notebook
+    look near-identical and serving the previous error's fix for the new
+    one. Embeddings come from the OpenAI embeddings API; when no OpenAI
+    client is configured only the exact layer is active. LRU-bounded.
+    """
+
+    def __init__(self, maxsize: int, threshold: float):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._exact: "OrderedDict[bytes, str]" = OrderedDict()
+        self._vectors: "OrderedDict[int, tuple]" = OrderedDict()  # id -> (scope, vector, response)
+        self._next_id = 0
+
+    async def lookup(self, key_text: str, embed_text: Optional[str] = None,
+                     scope: Optional[int] = None):
+        """
+        Look up a cached response.
+
+        key_text keys the exact layer; embed_text (default: key_text) is
+        what the semantic layer embeds, and scope restricts semantic
+        matches to entries stored under the same scope. Returns
+        (response, handle): response is None on a miss, and handle is what
+        store() needs to insert the eventual response (None when no insert
+        is needed because the lookup hit).
+        """
+        # Full digest rather than hash(): a 64-bit hash collision between
+        # two live prompts would silently serve the wrong response, and the
+        # original text is not kept around to detect it
+        exact_key = hashlib.sha256(key_text.encode()).digest()
+        cached = self._exact.get(exact_key)
+        if cached is not None:
+            self._exact.move_to_end(exact_key)
+            return cached, None
+
+        vector = await self._embed(embed_text if embed_text is not None else key_text)
+        if vector is not None and self._vectors:
+            # Snapshot before offloading: the pure-Python scan over up to
+            # maxsize 1536-dim vectors blocks for ~10ms at capacity, so it
+            # runs on the executor, and stores may land while it does
+            entries = list(self._vectors.items())
+            best_id, best_sim = await asyncio.to_thread(
+                self._scan, entries, vector, scope
+            )
+            if best_id is not None and best_sim >= self.threshold:
+                entry = self._vectors.get(best_id)  # may have been evicted
+                if entry is not None:
+                    self._vectors.move_to_end(best_id)
+                    return entry[2], None
+
+        return None, (exact_key, vector, scope)
+
+    @staticmethod
+    def _scan(entries, vector, scope):
+        """Return (id, similarity) of the best in-scope entry; runs off-loop."""
+        best_id, best_sim = None, 0.0
+        for entry_id, (entry_scope, other, _response) in entries:
+            if entry_scope != scope:
+                continue
+            # Vectors are normalized, so the dot product is the cosine
+            sim = sum(a * b for a, b in zip(vector, other))
+            if sim > best_sim:
+                best_id, best_sim = entry_id, sim
+        return best_id, best_sim
+
+    def store(self, handle, response: str):
+        """Insert a response under the handle returned by lookup()."""
+        if handle is None:
+            return
+        exact_key, vector, scope = handle
+
+        self._exact[exact_key] = response
+        if len(self._exact) > self.maxsize:
+            self._exact.popitem(last=False)
+
+        if vector is not None:
+            self._vectors[self._next_id] = (scope, vector, response)
+            self._next_id += 1
+            if len(self._vectors) > self.maxsize:
+                self._vectors.popitem(last=False)
+
+    @staticmethod
+    async def _embed(text: str) -> Optional[List[float]]:
+        """Embed and L2-normalize the prompt; None when unavailable."""
+        if not openai_client:
+            return None
+        try:
+            result = await openai_client.embeddings.create(
+                model=config.EMBEDDING_MODEL,
+                input=text[:8000]  # stay under the embedding token limit
+            )
+            vector = result.data[0].embedding
+            norm = sum(v * v for v in vector) ** 0.5
+            return [v / norm for v in vector] if norm else None
+        except Exception as e:
+            logger.debug(f"Embedding lookup failed, skipping semantic cache: {e}")
+            return None
+
+
+_semantic_cache = _SemanticCache(
+    maxsize=config.SEMANTIC_CACHE_SIZE,
+    threshold=config.SEMANTIC_CACHE_THRESHOLD,
+)
+
+
+# Static instruction blocks. These are kept byte-identical across calls (and
+# placed first in the prompt) so provider-side prompt caching can reuse the
+# cached prefix: OpenAI automatically caches prompt prefixes >= 1024 tokens,
+# and keeping the invariant text in a stable system message maximizes hits.
+ANALYZE_ERROR_INSTRUCTIONS = """You are an expert Python programmer helping debug a Jupyter notebook.
+
+Your task is to:
+1. Analyze the error in the context of ALL cells
+2. Identify which specific cells need to be fixed (could be just the error cell, or earlier cells)
+3. Provide the corrected code for each cell that needs fixing
+4. Decide if kernel restart is needed or if we can continue from a specific cell
+5. Explain your reasoning
+
+Respond in the following JSON format:
+{
+    "analysis": "Your analysis of what went wrong and why",
+    "cells_to_fix": ["cell_id_1", "cell_id_2"],
+    "fixes": {
+        "cell_id_1": "corrected code here",
+        "cell_id_2": "corrected code here"
+    },
+    "restart_needed": true/false,
+    "continue_from_cell": "cell_id_to_start_from",
+    "explanation": "Step-by-step explanation of the fix strategy"
+}
+
+IMPORTANT:
+- Only fix cells that actually need changes
+- Preserve code in cells that are working correctly
+- If the error is due to missing imports/setup in earlier cells, fix those cells
+- If it's just a bug in the current cell, only fix that cell
+- Consider variable state and dependencies between cells"""
+
+SUGGEST_CODE_INSTRUCTIONS = """You are an expert Python programmer helping write code in a Jupyter notebook.
+
+Generate appropriate Python code that:
+1. Builds on the existing notebook context
+2. Follows best practices
+3. Is well-commented
+4. Fulfills the user's request
+
+Respond in JSON format:
+{
+    "code": "your generated code here",
+    "explanation": "what this code does",
+    "cell_type": "code",
+    "dependencies": ["list of any new packages needed"]
+}"""
+
+OPTIMIZE_NOTEBOOK_INSTRUCTIONS = """You are an expert Python programmer reviewing a Jupyter notebook for optimization.
+
+Analyze the notebook and suggest:
+1. Code optimizations (performance, readability)
+2. Better organization of cells
+3. Missing error handling
+4. Potential bugs or issues
+
+Respond in JSON format:
+{
+    "suggestions": [
+        {
+            "cell_id": "cell_id",
+            "issue": "description of issue",
+            "suggested_fix": "corrected code or explanation",
+            "priority": "high/medium/low"
+        }
+    ],
+    "overall_assessment": "general feedback on the notebook"
+}"""
+
+
+CHAT_SYSTEM_MESSAGE = """You are an expert AI coding assistant integrated into a Jupyter notebook environment.
+
+You have tools to manipulate notebook cells:
+- read_cells: Read code from cells
+- update_cell: Modify existing cells
+- insert_cell: Add new cells at any position  
+- delete_cell: Remove cells
+- run_cell: Execute cells to test them
+- run_terminal_command: Run shell commands (pip install, file management, etc.)
+
+When the user asks you to do something:
+1. Use read_cells to understand the current state
+2. Use the appropriate tools to make changes
+3. Explain what you're doing and why
+4. Use run_cell to verify your changes work
+
+Be conversational and helpful. Think step by step."""
+
+# Repeated context fragments, built once
+_CELL_HEADER_PREFIX = "\n--- Cell "
+_ERROR_MARKER = " <<< ERROR HERE"
+
+# Compiled once; only consulted when the response actually contains a fence
+# that the cheap startswith/endswith strip could not isolate (e.g. prose
+# around the code block)
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+
+# Reasoning-model prefixes, materialized once from config
+_REASONING_PREFIXES = tuple(config.REASONING_MODELS)
+
+
+@lru_cache(maxsize=64)
+def _classify_model(model_name: str) -> tuple:
+    """
+    Classify a model name once: returns (provider, is_reasoning_model).
+
+    The prefix scans only run on the first sighting of a model name; every
+    later agent construction is a cache lookup.
+    """
+    if model_name.startswith("gpt-") or model_name.startswith("o1"):
+        provider = "openai"
+    elif model_name.startswith("gemini"):
+        provider = "gemini"
+    else:
+        # Default to OpenAI
+        provider = "openai"
+
+    is_reasoning = model_name.startswith(_REASONING_PREFIXES)
+    return provider, is_reasoning
+
+
+# Rendered cell blocks keyed by content hash. A cell whose code/outputs/error
+# did not change between requests renders to the same block, so editing cell N
+# no longer re-renders cells N+1..end. Bounded to avoid unbounded growth in
+# long sessions.
+_RENDER_CACHE: Dict[int, str] = {}
+_RENDER_CACHE_MAX = 4096
+
+# Fully joined contexts keyed by (cell hashes, highlight, start index). Rapid
+# successive agent calls on an unchanged notebook (retry, chat follow-up) hit
+# this instead of re-joining every block.
+_CONTEXT_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_CONTEXT_CACHE_MAX = 64
 
 
 class NotebookCell:
-    """Represents a notebook cell."""
-    
-    def __init__(self, cell_id: str, code: str, execution_count: Optional[int] = None, 
+    """
+    Represents a notebook cell.
+
+    Treated as immutable after construction (endpoints build fresh instances
+    per request), which lets the dict projection and content hash be computed
+    once and reused. __slots__ keeps instances compact - no per-instance
+    __dict__ - which matters with hundreds of cells per request.
+    """
+
+    __slots__ = ('cell_id', 'code', 'execution_count', 'outputs', 'error',
+                 '_content_hash', '_as_dict')
+
+    def __init__(self, cell_id: str, code: str, execution_count: Optional[int] = None,
                  outputs: List[Dict] = None, error: Optional[Dict] = None):
         self.cell_id = cell_id
         self.code = code
         self.execution_count = execution_count
         self.outputs = outputs or []
         self.error = error
-        
+        self._content_hash = None
+        self._as_dict = None
+
+    @classmethod
+    def from_model(cls, model) -> "NotebookCell":
+        """
+        Build a cell directly from a Pydantic NotebookCellModel.
+
+        The request payload was already validated by FastAPI, so this skips
+        __init__'s defaulting and assigns the slots straight from the model.
+        """
+        cell = cls.__new__(cls)
+        cell.cell_id = model.cell_id
+        cell.code = model.code
+        cell.execution_count = model.execution_count
+        cell.outputs = model.outputs
+        cell.error = model.error
+        cell._content_hash = None
+        cell._as_dict = None
+        return cell
+
+    @classmethod
+    def from_models(cls, models) -> List["NotebookCell"]:
+        """Convert a list of Pydantic cell models in one place."""
+        return [cls.from_model(model) for model in models]
+
     def to_dict(self):
-        return {
-            'cell_id': self.cell_id,
-            'code': self.code,
-            'execution_count': self.execution_count,
-            'outputs': self.outputs,
-            'error': self.error
-        }
+        """Dict projection of the cell, built once and cached."""
+        if self._as_dict is None:
+            self._as_dict = {
+                'cell_id': self.cell_id,
+                'code': self.code,
+                'execution_count': self.execution_count,
+                'outputs': self.outputs,
+                'error': self.error
+            }
+        return self._as_dict
+
+    @property
+    def content_hash(self) -> int:
+        """Stable hash of the cell content, computed lazily."""
+        if self._content_hash is None:
+            self._content_hash = hash((
+                self.cell_id,
+                self.code,
+                self.execution_count,
+                repr(self.outputs),
+                repr(self.error),
+            ))
+        return self._content_hash
+
+    def render_block(self) -> str:
+        """
+        Deterministic string rendering of this cell's code, outputs and error.
+
+        Memoized by content hash so unchanged cells are rendered once even
+        when surrounding cells are edited. Position-dependent text (cell
+        number, error marker) stays out of the block so the cache survives
+        cell reordering.
+        """
+        cached = _RENDER_CACHE.get(self.content_hash)
+        if cached is not None:
+            return cached
+
+        parts = [f"Code:\n{self.code}"]
+
+        if self.execution_count:
+            parts.append(f"Execution count: {self.execution_count}")
+
+        if self.outputs:
+            output_lines = []
+            for output in self.outputs:
+                if output['type'] == 'stream':
+                    # Whitespace-only stream chunks carry no signal
+                    text = output.get('text') or ''
+                    if text.strip():
+                        output_lines.append(f"  {output['name']}: {text}")
+                elif output['type'] == 'execute_result':
+                    data = output.get('data', {})
+                    if 'text/plain' in data:
+                        output_lines.append(f"  Result: {data['text/plain']}")
+            if output_lines:
+                parts.append("Outputs:")
+                parts.extend(output_lines)
+
+        if self.error:
+            parts.append(f"ERROR: {self.error['ename']}: {self.error['evalue']}")
+            traceback_lines = self.error['traceback']
+            if len(traceback_lines) > config.MAX_TRACEBACK_LINES:
+                # Keep head and tail; the middle of a deep traceback rarely
+                # adds signal and burns tokens
+                keep = config.MAX_TRACEBACK_LINES // 2
+                elided = len(traceback_lines) - 2 * keep
+                traceback_lines = (
+                    list(traceback_lines[:keep])
+                    + [f"... ({elided} traceback lines elided) ..."]
+                    + list(traceback_lines[-keep:])
+                )
+            parts.append(f"Traceback:\n" + "\n".join(traceback_lines))
+
+        block = "\n".join(parts)
+
+        if len(_RENDER_CACHE) >= _RENDER_CACHE_MAX:
+            _RENDER_CACHE.clear()
+        _RENDER_CACHE[self.content_hash] = block
+        return block
 
 
 class NotebookAgent:
@@ -55,27 +448,13 @@ class NotebookAgent:
     
     def __init__(self, model_name: str = "gpt-4o-mini"):
         self.model_name = model_name
-        self.provider = self._get_provider()
-        self.is_reasoning_model = self._is_reasoning_model()
-        
+        self.provider, self.is_reasoning_model = _classify_model(model_name)
+
         # Initialize model based on provider
         if self.provider == "gemini":
             self.gemini_model = genai.GenerativeModel(model_name)
-        
-    def _get_provider(self) -> str:
-        """Determine which AI provider to use based on model name."""
-        if self.model_name.startswith("gpt-") or self.model_name.startswith("o1"):
-            return "openai"
-        elif self.model_name.startswith("gemini"):
-            return "gemini"
-        else:
-            # Default to OpenAI
-            return "openai"
-    
-    def _is_reasoning_model(self) -> bool:
-        """Check if this is a reasoning model (uses reasoning_effort instead of temperature)."""
-        return any(self.model_name.startswith(rm) for rm in config.REASONING_MODELS)
-        
+
+
     async def analyze_error(self, cells: List[NotebookCell], error_cell_id: str) -> Dict[str, Any]:
         """
         Analyze an error in context of all cells.
@@ -87,46 +466,19 @@ class NotebookAgent:
             - restart_needed: Whether kernel restart is recommended
             - continue_from: Cell ID to continue execution from
         """
-        # Build notebook context
-        notebook_context = self._build_notebook_context(cells, error_cell_id)
-        
-        prompt = f"""You are an expert Python programmer helping debug a Jupyter notebook.
-
-NOTEBOOK CONTEXT:
-{notebook_context}
-
-The error occurred in cell {error_cell_id}.
-
-Your task is to:
-1. Analyze the error in the context of ALL cells
-2. Identify which specific cells need to be fixed (could be just the error cell, or earlier cells)
-3. Provide the corrected code for each cell that needs fixing
-4. Decide if kernel restart is needed or if we can continue from a specific cell
-5. Explain your reasoning
-
-Respond in the following JSON format:
-{{
-    "analysis": "Your analysis of what went wrong and why",
-    "cells_to_fix": ["cell_id_1", "cell_id_2"],
-    "fixes": {{
-        "cell_id_1": "corrected code here",
-        "cell_id_2": "corrected code here"
-    }},
-    "restart_needed": true/false,
-    "continue_from_cell": "cell_id_to_start_from",
-    "explanation": "Step-by-step explanation of the fix strategy"
-}}
-
-IMPORTANT: 
-- Only fix cells that actually need changes
-- Preserve code in cells that are working correctly
-- If the error is due to missing imports/setup in earlier cells, fix those cells
-- If it's just a bug in the current cell, only fix that cell
-- Consider variable state and dependencies between cells
-"""
+        # Split the context so the stable prefix (instructions + cells before
+        # the error) lands in the system message and only the changed tail is
+        # re-sent as the user message.
+        system_prompt, user_prompt = self._build_cached_prompt(
+            ANALYZE_ERROR_INSTRUCTIONS,
+            cells,
+            task=f"The error occurred in cell {error_cell_id}. Analyze and fix it.",
+            pivot_cell_id=error_cell_id,
+            highlight_cell=error_cell_id,
+        )
 
         try:
-            response = await self._generate_response(prompt)
+            response = await self._generate_response(system_prompt, user_prompt)
             parsed_response = self._parse_json_response(response)
             return parsed_response
             
@@ -146,32 +498,14 @@ IMPORTANT:
         """
         Suggest code based on user request and notebook context.
         """
-        notebook_context = self._build_notebook_context(cells)
-        
-        prompt = f"""You are an expert Python programmer helping write code in a Jupyter notebook.
-
-CURRENT NOTEBOOK STATE:
-{notebook_context}
-
-USER REQUEST: {user_request}
-
-Generate appropriate Python code that:
-1. Builds on the existing notebook context
-2. Follows best practices
-3. Is well-commented
-4. Fulfills the user's request
-
-Respond in JSON format:
-{{
-    "code": "your generated code here",
-    "explanation": "what this code does",
-    "cell_type": "code",
-    "dependencies": ["list of any new packages needed"]
-}}
-"""
+        system_prompt, user_prompt = self._build_cached_prompt(
+            SUGGEST_CODE_INSTRUCTIONS,
+            cells,
+            task=f"USER REQUEST: {user_request}",
+        )
 
         try:
-            response = await self._generate_response(prompt)
+            response = await self._generate_response(system_prompt, user_prompt)
             return self._parse_json_response(response)
         except Exception as e:
             logger.error(f"Error generating code: {e}")
@@ -185,43 +519,75 @@ Respond in JSON format:
     async def optimize_notebook(self, cells: List[NotebookCell]) -> Dict[str, Any]:
         """
         Suggest optimizations for the entire notebook.
+
+        Each cell is analyzed in its own request, fanned out concurrently
+        (capped by a semaphore to stay under provider rate limits) rather
+        than serialized through one giant completion. The full notebook
+        context is shared as the system prompt so it stays cacheable.
         """
+        if not cells:
+            return {"suggestions": [], "overall_assessment": "Notebook is empty."}
+
         notebook_context = self._build_notebook_context(cells)
-        
-        prompt = f"""You are an expert Python programmer reviewing a Jupyter notebook for optimization.
+        system_prompt = (
+            f"{OPTIMIZE_NOTEBOOK_INSTRUCTIONS}\n\n"
+            f"NOTEBOOK CONTEXT:\n{notebook_context}"
+        )
 
-NOTEBOOK:
-{notebook_context}
+        semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_LLM_CALLS)
 
-Analyze this notebook and suggest:
-1. Code optimizations (performance, readability)
-2. Better organization of cells
-3. Missing error handling
-4. Potential bugs or issues
-
-Respond in JSON format:
-{{
-    "suggestions": [
-        {{
-            "cell_id": "cell_id",
-            "issue": "description of issue",
-            "suggested_fix": "corrected code or explanation",
-            "priority": "high/medium/low"
-        }}
-    ],
-    "overall_assessment": "general feedback on the notebook"
-}}
-"""
+        async def analyze_cell(cell: NotebookCell) -> str:
+            user_prompt = (
+                f"Focus ONLY on cell {cell.cell_id}. Suggest optimizations for "
+                f"that cell in the JSON format above (suggestions may be empty "
+                f"if the cell is fine)."
+            )
+            async with semaphore:
+                return await self._generate_with_retry(system_prompt, user_prompt)
 
         try:
-            response = await self._generate_response(prompt)
-            return self._parse_json_response(response)
+            responses = await asyncio.gather(
+                *(analyze_cell(cell) for cell in cells),
+                return_exceptions=True
+            )
+
+            suggestions = []
+            assessments = []
+            for cell, response in zip(cells, responses):
+                if isinstance(response, Exception):
+                    logger.warning(f"Optimization failed for cell {cell.cell_id}: {response}")
+                    continue
+                try:
+                    parsed = self._parse_json_response(response)
+                except ValueError:
+                    continue
+                suggestions.extend(parsed.get("suggestions", []))
+                assessment = parsed.get("overall_assessment")
+                if assessment:
+                    assessments.append(assessment)
+
+            return {
+                "suggestions": suggestions,
+                "overall_assessment": " ".join(assessments) if assessments else "No issues found."
+            }
         except Exception as e:
             logger.error(f"Error optimizing notebook: {e}")
             return {
                 "suggestions": [],
                 "overall_assessment": f"Error: {str(e)}"
             }
+
+    async def _generate_with_retry(self, system_prompt: str, user_prompt: str) -> str:
+        """Generate a response, backing off exponentially on rate limits."""
+        for attempt in range(config.MAX_RETRY_ATTEMPTS):
+            try:
+                return await self._generate_response(system_prompt, user_prompt)
+            except RateLimitError:
+                if attempt == config.MAX_RETRY_ATTEMPTS - 1:
+                    raise
+                delay = 2 ** attempt
+                logger.warning(f"Rate limited, retrying in {delay}s")
+                await asyncio.sleep(delay)
     
     async def chat(self, cells: List[NotebookCell], user_message: str, conversation_history: List[Dict] = None) -> Dict[str, Any]:
         """
@@ -236,7 +602,6 @@ Respond in JSON format:
         Returns:
             Response with message and any tool calls made
         """
-        from cell_tools import CellTool
         
         # Build context
         notebook_context = self._build_notebook_context(cells)
@@ -246,24 +611,7 @@ Respond in JSON format:
         
         # Add system message if this is the first message
         if not messages:
-            system_message = """You are an expert AI coding assistant integrated into a Jupyter notebook environment.
-
-You have tools to manipulate notebook cells:
-- read_cells: Read code from cells
-- update_cell: Modify existing cells
-- insert_cell: Add new cells at any position  
-- delete_cell: Remove cells
-- run_cell: Execute cells to test them
-- run_terminal_command: Run shell commands (pip install, file management, etc.)
-
-When the user asks you to do something:
-1. Use read_cells to understand the current state
-2. Use the appropriate tools to make changes
-3. Explain what you're doing and why
-4. Use run_cell to verify your changes work
-
-Be conversational and helpful. Think step by step."""
-            messages.append({"role": "system", "content": system_message})
+            messages.append({"role": "system", "content": CHAT_SYSTEM_MESSAGE})
         
         # Add context about current notebook
         context_message = f"Current notebook state:\n{notebook_context}\n\nUser: {user_message}"
@@ -276,15 +624,39 @@ Be conversational and helpful. Think step by step."""
             # Fallback to regular chat for Gemini
             return await self._chat_without_tools(messages)
     
+    async def chat_stream(self, cells: List[NotebookCell], user_message: str,
+                          conversation_history: List[Dict] = None):
+        """
+        Stream a plain-text chat reply token by token.
+
+        Tool calls only become actionable once the full response has
+        arrived, so the streaming path answers without tools; it exists for
+        the conversational experience where time-to-first-token matters.
+        Prior turns are folded into the prompt as transcript lines.
+        """
+        notebook_context = self._build_notebook_context(cells)
+
+        parts = [f"Current notebook state:\n{notebook_context}"]
+        for turn in conversation_history or []:
+            role = turn.get("role")
+            content = turn.get("content")
+            if role in ("user", "assistant") and content:
+                parts.append(f"{role.capitalize()}: {content}")
+        parts.append(f"User: {user_message}")
+
+        async for chunk in self.stream_response(CHAT_SYSTEM_MESSAGE, "\n\n".join(parts)):
+            yield chunk
+
     async def _chat_with_tools_openai(self, messages: List[Dict], cells: List[NotebookCell]) -> Dict[str, Any]:
         """Chat with OpenAI using function calling."""
-        from cell_tools import CellTool
         
         if not openai_client:
             raise ValueError("OpenAI client not configured")
         
-        # Prepare cells state for tool execution
+        # Prepare cells state for tool execution, with an ID index built once
+        # per turn so each tool call resolves cells in O(1)
         cells_state = [cell.to_dict() for cell in cells]
+        cells_by_id = {state['cell_id']: state for state in cells_state}
         
         # Build API parameters
         api_params = {
@@ -309,12 +681,18 @@ Be conversational and helpful. Think step by step."""
         tool_calls = []
         if message.tool_calls:
             for tool_call in message.tool_calls:
-                import json
                 tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
+                try:
+                    tool_args = orjson.loads(tool_call.function.arguments)
+                except orjson.JSONDecodeError:
+                    # orjson is strict about UTF-8 and JSON conformance;
+                    # fall back to stdlib for edge cases
+                    tool_args = json.loads(tool_call.function.arguments)
                 
-                # Execute the tool
-                tool_result = CellTool.execute_tool(tool_name, tool_args, cells_state)
+                # Execute the tool (async path keeps the loop free for tools
+                # that actually block)
+                tool_result = await CellTool.execute_tool_async(tool_name, tool_args,
+                                                                cells_state, cells_by_id)
                 
                 tool_calls.append({
                     "id": tool_call.id,
@@ -342,108 +720,540 @@ Be conversational and helpful. Think step by step."""
             "finish_reason": "stop"
         }
     
-    def _build_notebook_context(self, cells: List[NotebookCell], highlight_cell: Optional[str] = None) -> str:
-        """Build a string representation of the notebook context."""
-        context_parts = []
-        
-        for i, cell in enumerate(cells):
-            marker = " <<< ERROR HERE" if cell.cell_id == highlight_cell else ""
-            context_parts.append(f"\n--- Cell {i+1} (ID: {cell.cell_id}){marker} ---")
-            context_parts.append(f"Code:\n{cell.code}")
-            
-            if cell.execution_count:
-                context_parts.append(f"Execution count: {cell.execution_count}")
-            
-            if cell.outputs:
-                context_parts.append("Outputs:")
-                for output in cell.outputs:
-                    if output['type'] == 'stream':
-                        context_parts.append(f"  {output['name']}: {output['text']}")
-                    elif output['type'] == 'execute_result':
-                        data = output.get('data', {})
-                        if 'text/plain' in data:
-                            context_parts.append(f"  Result: {data['text/plain']}")
-            
-            if cell.error:
-                context_parts.append(f"ERROR: {cell.error['ename']}: {cell.error['evalue']}")
-                context_parts.append(f"Traceback:\n" + "\n".join(cell.error['traceback']))
-        
-        return "\n".join(context_parts)
+    def _build_cached_prompt(self, instructions: str, cells: List[NotebookCell],
+                             task: str, pivot_cell_id: Optional[str] = None,
+                             highlight_cell: Optional[str] = None) -> tuple:
+        """
+        Split a request into a (system_prompt, user_prompt) pair.
+
+        The system prompt holds the invariant text: static instructions plus
+        the cells before the pivot (the error cell, or the last cell when no
+        pivot is given). Those cells rarely change between successive calls,
+        so the system prompt stays byte-identical and provider prompt caches
+        (OpenAI caches >=1024-token prefixes automatically) can reuse it.
+        The user prompt carries only the changed tail and the actual task.
+        """
+        # Find the pivot: the first cell that may have changed since last call
+        pivot_index = len(cells) - 1 if cells else 0
+        if pivot_cell_id is not None:
+            for i, cell in enumerate(cells):
+                if cell.cell_id == pivot_cell_id:
+                    pivot_index = i
+                    break
+
+        stable_cells = cells[:pivot_index]
+        tail_cells = cells[pivot_index:]
+
+        system_prompt = instructions
+        if stable_cells:
+            stable_context = self._build_notebook_context(stable_cells)
+            system_prompt = f"{instructions}\n\nNOTEBOOK CONTEXT (earlier cells):\n{stable_context}"
+
+        user_parts = []
+        if tail_cells:
+            tail_context = self._build_notebook_context(tail_cells, highlight_cell,
+                                                        start_index=pivot_index)
+            user_parts.append(f"LATEST CELLS:\n{tail_context}")
+        user_parts.append(task)
+        user_prompt = "\n\n".join(user_parts)
+
+        return system_prompt, user_prompt
+
+    def _build_notebook_context(self, cells: List[NotebookCell], highlight_cell: Optional[str] = None,
+                                start_index: int = 0) -> str:
+        """
+        Build a string representation of the notebook context.
+
+        The output is deterministic for unchanged cells (fixed key order, no
+        timestamps), so the same cells always render to the same bytes.
+        Results are memoized per (cell hashes, highlight, start index) with
+        LRU eviction; any cell edit changes its hash and misses the cache.
+        """
+        key = (tuple(cell.content_hash for cell in cells), highlight_cell, start_index)
+        cached = _CONTEXT_CACHE.get(key)
+        if cached is not None:
+            _CONTEXT_CACHE.move_to_end(key)
+            return cached
+
+        def iter_parts():
+            for i, cell in enumerate(cells, start=start_index):
+                marker = _ERROR_MARKER if cell.cell_id == highlight_cell else ""
+                yield f"{_CELL_HEADER_PREFIX}{i + 1} (ID: {cell.cell_id}){marker} ---"
+                yield cell.render_block()
+
+        # Single join over a generator: no intermediate list of parts, one
+        # final allocation for the context string
+        context = "\n".join(iter_parts())
+
+        # Over budget (~4 chars/token estimate): keep the focus cell and its
+        # neighbors verbatim, compress everything else to one-line signatures
+        if len(context) > config.MAX_CONTEXT_TOKENS * 4:
+            context = self._build_compact_context(cells, highlight_cell, start_index)
+
+        _CONTEXT_CACHE[key] = context
+        if len(_CONTEXT_CACHE) > _CONTEXT_CACHE_MAX:
+            _CONTEXT_CACHE.popitem(last=False)
+        return context
     
-    async def _generate_response(self, prompt: str) -> str:
-        """Generate response from AI model (OpenAI or Gemini)."""
+    def _build_compact_context(self, cells: List[NotebookCell],
+                               highlight_cell: Optional[str] = None,
+                               start_index: int = 0) -> str:
+        """
+        Compressed context for notebooks that exceed the token budget.
+
+        The focus cell (highlighted, or the last cell) and its nearest
+        neighbors keep their full blocks; every other cell collapses to a
+        one-line signature. This bounds input tokens on large notebooks and
+        avoids context-window 400s.
+        """
+        focus = len(cells) - 1
+        if highlight_cell is not None:
+            for i, cell in enumerate(cells):
+                if cell.cell_id == highlight_cell:
+                    focus = i
+                    break
+
+        parts = []
+        for i, cell in enumerate(cells):
+            number = i + start_index + 1
+            if abs(i - focus) <= config.CONTEXT_FULL_CELL_NEIGHBORS:
+                marker = _ERROR_MARKER if cell.cell_id == highlight_cell else ""
+                parts.append(f"{_CELL_HEADER_PREFIX}{number} (ID: {cell.cell_id}){marker} ---")
+                parts.append(cell.render_block())
+            else:
+                first_line = cell.code.split("\n", 1)[0][:80] if cell.code else ""
+                error_note = ", has error" if cell.error else ""
+                parts.append(
+                    f"Cell {number} (id={cell.cell_id}): {first_line} "
+                    f"-- {len(cell.code)} chars{error_note}"
+                )
+        return "\n".join(parts)
+
+    async def _generate_response(self, system_prompt: str, user_prompt: str) -> str:
+        """
+        Generate a full response by collecting the streamed chunks.
+
+        Checked against the semantic cache first: repeated or near-identical
+        prompts (same traceback retried, trivially reworded requests) return
+        the cached response in milliseconds instead of a full LLM call.
+        """
+        if not config.SEMANTIC_CACHE_ENABLED:
+            return await self._collect(self.stream_response(system_prompt, user_prompt))
+
+        # The model name is part of the key: different models may answer
+        # differently. Only the user prompt is embedded - it carries what
+        # varies between calls (the error, the task) - while the invariant
+        # model + system prompt pair scopes which entries may match.
+        cache_key = f"{self.model_name}\n{system_prompt}\n{user_prompt}"
+        cached, handle = await _semantic_cache.lookup(
+            cache_key,
+            embed_text=user_prompt,
+            scope=hash((self.model_name, system_prompt)),
+        )
+        if cached is not None:
+            return cached
+
+        response = await self._collect(self.stream_response(system_prompt, user_prompt))
+        _semantic_cache.store(handle, response)
+        return response
+
+    async def stream_response(self, system_prompt: str, user_prompt: str):
+        """
+        Stream response chunks from the AI model (OpenAI or Gemini).
+
+        Yields text deltas as the provider produces them, so callers can
+        forward tokens to the client instead of waiting for the full
+        completion. Use _collect() when the whole string is needed.
+        """
         if self.provider == "openai":
-            return await self._generate_openai_response(prompt)
+            stream = self._stream_openai_response(system_prompt, user_prompt)
         else:
-            return await self._generate_gemini_response(prompt)
-    
-    async def _generate_openai_response(self, prompt: str) -> str:
-        """Generate response from OpenAI."""
+            # Gemini has no separate system role in this SDK; join the parts
+            stream = self._stream_gemini_response(f"{system_prompt}\n\n{user_prompt}")
+
+        async for chunk in stream:
+            yield chunk
+
+    @staticmethod
+    async def _collect(stream) -> str:
+        """Collect an async stream of text chunks into one string."""
+        return "".join([chunk async for chunk in stream])
+
+    async def _stream_openai_response(self, system_prompt: str, user_prompt: str):
+        """
+        Stream a response from OpenAI.
+
+        The system prompt is sent first and unchanged across calls so that
+        OpenAI's automatic prefix caching can reuse it.
+        """
         if not openai_client:
             raise ValueError("OpenAI client not configured. Please set OPENAI_API_KEY in .env")
-        
+
         # Build API parameters based on model type
         api_params = {
             "model": self.model_name,
-            "messages": [{"role": "user", "content": prompt}]
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "stream": True
         }
-        
+
         # Reasoning models use reasoning_effort, non-reasoning models use temperature
         if self.is_reasoning_model:
             api_params["reasoning_effort"] = config.DEFAULT_REASONING_EFFORT
         else:
             api_params["temperature"] = config.DEFAULT_TEMPERATURE
-        
+
         response = await openai_client.chat.completions.create(**api_params)
-        return response.choices[0].message.content
-    
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
     async def _generate_gemini_response(self, prompt: str) -> str:
-        """Generate response from Gemini."""
-        import asyncio
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: self.gemini_model.generate_content(prompt)
-        )
-        return response.text
+        """Generate a full response from Gemini."""
+        return await self._collect(self._stream_gemini_response(prompt))
+
+    async def _stream_gemini_response(self, prompt: str):
+        """
+        Stream a response from Gemini.
+
+        Uses the SDK's native async API when present (no thread needed).
+        Older SDKs only expose a blocking iterator; that one is pumped on a
+        dedicated I/O thread pool and chunks are handed back to the event
+        loop through a queue, so Gemini traffic cannot starve the default
+        executor shared with the rest of the process.
+        """
+        if hasattr(self.gemini_model, "generate_content_async"):
+            response = await self.gemini_model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+            return
+
+        loop = asyncio.get_running_loop()
+        chunk_queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def pump():
+            try:
+                for chunk in self.gemini_model.generate_content(prompt, stream=True):
+                    if chunk.text:
+                        loop.call_soon_threadsafe(chunk_queue.put_nowait, chunk.text)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunk_queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(chunk_queue.put_nowait, done)
+
+        loop.run_in_executor(_GEMINI_EXECUTOR, pump)
+
+        while True:
+            item = await chunk_queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
     
     def _parse_json_response(self, response: str) -> Dict[str, Any]:
         """Parse JSON from model response."""
-        import json
-        import re
-        
-        # Try to extract JSON from markdown code blocks
-        json_match = re.search(r'```json\s*(.*?)\s*```', response, re.DOTALL)
-        if json_match:
-            response = json_match.group(1)
-        
-        # Try to parse
+        # Fast path: the response is already plain JSON
         try:
-            return json.loads(response)
-        except json.JSONDecodeError:
-            # Try to find JSON object in the response
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group(0))
-            raise ValueError("Could not parse JSON from response")
+            return orjson.loads(response)
+        except orjson.JSONDecodeError:
+            pass
+
+        # Strip a markdown code fence without regex
+        stripped = response.strip()
+        if stripped.startswith("```"):
+            stripped = stripped[3:]
+            if stripped.startswith("json"):
+                stripped = stripped[4:]
+            if stripped.endswith("```"):
+                stripped = stripped[:-3]
+            try:
+                return orjson.loads(stripped)
+            except orjson.JSONDecodeError:
+                pass
+
+        # Fence embedded in surrounding prose: one precompiled regex pass,
+        # gated so fence-free responses never pay for the DOTALL scan
+        if "```" in response:
+            fence_match = _JSON_FENCE_RE.search(response)
+            if fence_match:
+                try:
+                    return orjson.loads(fence_match.group(1))
+                except orjson.JSONDecodeError:
+                    pass
+
+        # Last resort: single left-to-right scan for the outermost {...} span,
+        # tracking string/escape state so braces inside strings don't count
+        span = self._find_json_object(response)
+        if span is not None:
+            try:
+                return orjson.loads(response[span[0]:span[1]])
+            except orjson.JSONDecodeError:
+                pass
+        raise ValueError("Could not parse JSON from response")
+
+    @staticmethod
+    def _find_json_object(text: str) -> Optional[tuple]:
+        """Find the span of the outermost {...} object via one linear scan."""
+        start = -1
+        depth = 0
+        in_string = False
+        escaped = False
+        for i, ch in enumerate(text):
+            if escaped:
+                escaped = False
+                continue
+            if ch == '\\':
+                escaped = in_string
+                continue
+            if ch == '"':
+                in_string = not in_string
+                continue
+            if in_string:
+                continue
+            if ch == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif ch == '}' and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    return (start, i + 1)
+        return None
+
+
+# Instruction blocks per batch mode
+_BATCH_MODE_INSTRUCTIONS = {
+    "optimize": OPTIMIZE_NOTEBOOK_INSTRUCTIONS,
+    "analyze": ANALYZE_ERROR_INSTRUCTIONS,
+}
 
 
 class AgentService:
     """Service for managing AI agents with different models."""
-    
+
+    MAX_AGENTS = 16
+
     def __init__(self):
-        self.agents: Dict[str, NotebookAgent] = {}
+        # LRU-bounded: each Gemini agent pins a GenerativeModel, so an
+        # unbounded dict leaks slowly when many model names are exercised
+        self.agents: "OrderedDict[str, NotebookAgent]" = OrderedDict()
         self.default_model = "gpt-4o-mini"
-    
+        self._lock = threading.Lock()
+
     def get_agent(self, model_name: Optional[str] = None) -> NotebookAgent:
-        """Get or create an agent for a specific model."""
+        """Get or create an agent for a specific model (LRU, thread-safe)."""
         model = model_name or self.default_model
-        
-        if model not in self.agents:
-            self.agents[model] = NotebookAgent(model)
-        
-        return self.agents[model]
+
+        with self._lock:
+            agent = self.agents.get(model)
+            if agent is not None:
+                self.agents.move_to_end(model)
+                return agent
+
+            agent = NotebookAgent(model)
+            self.agents[model] = agent
+            if len(self.agents) > self.MAX_AGENTS:
+                evicted, _ = self.agents.popitem(last=False)
+                logger.info(f"Evicted least recently used agent: {evicted}")
+            return agent
+
+    async def run_batch_async(self, prompts: List[str], mode: str = "optimize",
+                              model_name: Optional[str] = None,
+                              poll_interval: float = 30.0) -> List[Dict[str, Any]]:
+        """
+        Run many prompts as one offline batch job.
+
+        For OpenAI models this uses the Batch API (~50% cheaper than live
+        calls): prompts are packaged as JSONL, uploaded, submitted with a
+        24h completion window, polled until done, then demultiplexed by
+        custom_id back into input order. Gemini's SDK here has no batch
+        endpoint, so those models fan out concurrently instead.
+
+        Args:
+            prompts: One user prompt per job entry.
+            mode: "optimize" or "analyze" - selects the instruction block.
+            model_name: Model to run the batch on (defaults to the service default).
+            poll_interval: Seconds between batch status polls.
+
+        Returns:
+            List of parsed responses, in the same order as `prompts`.
+        """
+
+        if mode not in _BATCH_MODE_INSTRUCTIONS:
+            raise ValueError(f"Unknown batch mode: {mode}")
+
+        instructions = _BATCH_MODE_INSTRUCTIONS[mode]
+        agent = self.get_agent(model_name)
+
+        if agent.provider != "openai":
+            # No batch endpoint in the Gemini SDK; run concurrently instead
+            responses = await asyncio.gather(*(
+                agent._generate_response(instructions, prompt) for prompt in prompts
+            ))
+            return [agent._parse_json_response(r) for r in responses]
+
+        if not openai_client:
+            raise ValueError("OpenAI client not configured. Please set OPENAI_API_KEY in .env")
+
+        # Package each prompt as one JSONL request line
+        lines = []
+        for i, prompt in enumerate(prompts):
+            body = {
+                "model": agent.model_name,
+                "messages": [
+                    {"role": "system", "content": instructions},
+                    {"role": "user", "content": prompt}
+                ]
+            }
+            if agent.is_reasoning_model:
+                body["reasoning_effort"] = config.DEFAULT_REASONING_EFFORT
+            else:
+                body["temperature"] = config.DEFAULT_TEMPERATURE
+            lines.append(json.dumps({
+                "custom_id": f"req-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }))
+        jsonl_data = "\n".join(lines).encode("utf-8")
+
+        # Upload and submit the batch
+        batch_file = await openai_client.files.create(
+            file=("batch.jsonl", jsonl_data),
+            purpose="batch"
+        )
+        batch = await openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+
+        # Poll until the batch reaches a terminal state
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await openai_client.batches.retrieve(batch.id)
+
+        if batch.status != "completed":
+            raise RuntimeError(f"Batch {batch.id} finished with status: {batch.status}")
+
+        # Download results and demultiplex by custom_id
+        output = await openai_client.files.content(batch.output_file_id)
+        by_custom_id = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            content = entry["response"]["body"]["choices"][0]["message"]["content"]
+            by_custom_id[entry["custom_id"]] = content
+
+        results = []
+        for i in range(len(prompts)):
+            content = by_custom_id.get(f"req-{i}")
+            if content is None:
+                results.append({"error": f"No result for request {i}"})
+                continue
+            try:
+                results.append(agent._parse_json_response(content))
+            except ValueError:
+                results.append({"response": content})
+        return results
+
+    def run_batch(self, prompts: List[str], mode: str = "optimize",
+                  model_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Synchronous wrapper around run_batch_async, mirroring .batch()/.abatch()."""
+        return asyncio.run(self.run_batch_async(prompts, mode=mode, model_name=model_name))
+
+
+class AgentCallBatcher:
+    """
+    Micro-batches near-simultaneous agent calls per model.
+
+    Requests landing within AGENT_BATCH_MAX_LATENCY_MS of each other are
+    collected into one group (capped at AGENT_BATCH_MAX_SIZE) and dispatched
+    together. The chat APIs take one conversation per request, so "together"
+    means a single gather over the group sharing the pooled HTTP client and
+    one scheduling pass, rather than a literal multi-prompt call; the
+    grouping also gives the provider back-to-back requests that HTTP/2
+    multiplexes onto one connection.
+
+    Batches dispatch as background tasks, so the collector keeps forming
+    new groups while earlier ones are in flight; a slow call only delays
+    its own batch, never subsequent traffic on the model. Overall outbound
+    concurrency stays bounded by the per-model semaphores in main.
+    """
+
+    def __init__(self, max_batch_size: int, max_latency_ms: float):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        # One queue + collector task per model, created on first use
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._collectors: Dict[str, asyncio.Task] = {}
+        # Strong references to in-flight dispatch tasks (fire-and-forget
+        # tasks are otherwise garbage-collectable mid-run)
+        self._inflight: set = set()
+
+    async def submit(self, model_name: str, call) -> Any:
+        """
+        Queue a zero-argument coroutine function and await its result.
+
+        The collector for the model invokes `call()` as part of the next
+        dispatched group.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request_queue = self._queues.get(model_name)
+        if request_queue is None:
+            request_queue = self._queues[model_name] = asyncio.Queue()
+            self._collectors[model_name] = loop.create_task(
+                self._collect_loop(request_queue)
+            )
+        request_queue.put_nowait((call, future))
+        return await future
+
+    async def _collect_loop(self, request_queue: asyncio.Queue):
+        while True:
+            batch = [await request_queue.get()]
+            # First request opens the batching window; gather whatever else
+            # arrives before it closes or the batch fills up
+            deadline = asyncio.get_running_loop().time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(request_queue.get(),
+                                                        timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without awaiting: awaiting here would serialize all
+            # traffic on the model behind the slowest call of this batch
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    @staticmethod
+    async def _dispatch(batch):
+        results = await asyncio.gather(*(call() for call, _ in batch),
+                                       return_exceptions=True)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue  # caller went away (disconnect/cancellation)
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
 
 # Global agent service
 agent_service = AgentService()
+
+# Global micro-batcher for the /agent/* endpoints
+agent_batcher = AgentCallBatcher(
+    max_batch_size=config.AGENT_BATCH_MAX_SIZE,
+    max_latency_ms=config.AGENT_BATCH_MAX_LATENCY_MS,
+)
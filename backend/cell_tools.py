@@ -1,4 +1,5 @@
 """Tools for AI agents to manipulate notebook cells and run terminal commands."""
+import asyncio
 from typing import List, Dict, Any, Optional
 
 class CellTool:
@@ -145,35 +146,184 @@ class CellTool:
 
     @staticmethod
     def get_openai_tool_definitions():
-        """Get all tool definitions for OpenAI."""
-        return [
-            CellTool.read_cells(),
-            CellTool.update_cell(),
-            CellTool.insert_cell(),
-            CellTool.delete_cell(),
-            CellTool.run_cell(),
-            CellTool.run_terminal_command()
-        ]
-    
+        """
+        Get all tool definitions for OpenAI.
+
+        Returns the module-level tuple built once at import; callers must
+        treat it as read-only.
+        """
+        return _TOOL_DEFINITIONS
+
     # Alias for compatibility if needed
     get_tools_definition = get_openai_tool_definitions
 
     @staticmethod
-    def execute_tool(name: str, args: Dict[str, Any], cells_state: List[Dict] = None) -> Dict[str, Any]:
+    def execute_tool(name: str, args: Dict[str, Any], cells_state: List[Dict] = None,
+                     cells_by_id: Dict[str, Dict] = None) -> Dict[str, Any]:
         """
         Simulate tool execution (returns the action to be taken).
+
+        Dispatches through the module-level handler table: O(1) lookup
+        instead of a chain of string compares per tool call. Callers issuing
+        several tool calls against the same cells should build the
+        cells_by_id index once and pass it in; otherwise it is derived here.
         """
-        if name == "read_cells":
-            return {"action": "read_cells", "success": True}
-        elif name == "update_cell":
-            return {"action": "update_cell", "cell_id": args.get("cell_id"), "code": args.get("code"), "success": True}
-        elif name == "insert_cell":
-            return {"action": "insert_cell", "code": args.get("code"), "index": args.get("index", -1), "success": True}
-        elif name == "delete_cell":
-            return {"action": "delete_cell", "cell_id": args.get("cell_id"), "success": True}
-        elif name == "run_cell":
-            return {"action": "run_cell", "cell_id": args.get("cell_id"), "success": True}
-        elif name == "run_terminal_command":
-            return {"action": "run_terminal_command", "command": args.get("command"), "success": True}
-        else:
+        handler = _TOOL_HANDLERS.get(name)
+        if handler is None:
             return {"error": f"Unknown tool: {name}", "success": False}
+        if cells_by_id is None and cells_state:
+            cells_by_id = {cell["cell_id"]: cell for cell in cells_state}
+        return handler(args, cells_state, cells_by_id)
+
+    @staticmethod
+    async def execute_tool_async(name: str, args: Dict[str, Any],
+                                 cells_state: List[Dict] = None,
+                                 cells_by_id: Dict[str, Dict] = None) -> Dict[str, Any]:
+        """
+        Async entry point for tool execution.
+
+        Tools with a coroutine handler (anything that will eventually block:
+        shelling out, running cells) execute off the caller's control flow
+        here; everything else falls through to the sync dispatch table.
+        Chat code should call this so a slow tool never blocks the event
+        loop once real handlers land.
+        """
+        handler = _ASYNC_TOOL_HANDLERS.get(name)
+        if handler is not None:
+            return await handler(args, cells_state, cells_by_id)
+        return CellTool.execute_tool(name, args, cells_state, cells_by_id)
+
+    @staticmethod
+    async def run_shell_command(command: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Run a shell command without blocking the event loop.
+
+        Uses asyncio's subprocess support, so other coroutines keep running
+        for the duration of the command. Kills the process on timeout.
+        """
+        proc = await asyncio.create_subprocess_shell(
+            command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return {
+                "stdout": "",
+                "stderr": f"Command timed out after {timeout}s",
+                "returncode": -1,
+                "success": False,
+            }
+        return {
+            "stdout": stdout.decode("utf-8", errors="replace"),
+            "stderr": stderr.decode("utf-8", errors="replace"),
+            "returncode": proc.returncode,
+            "success": proc.returncode == 0,
+        }
+
+
+# Handler per tool. Plain module-level functions (not lambdas or bound
+# methods) so the dispatch table stores bare function references and each
+# handler has room to grow real behavior around the cells state.
+def _cell_projection(cell: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The read-only view of a cell handed back to the model.
+
+    Built lazily and cached on the cell dict itself, so repeated
+    read_cells calls in a multi-tool loop reuse one dict per cell
+    instead of reallocating the projection every time. Mutation
+    handlers drop the cached copy for the cell they touch.
+    """
+    projection = cell.get("_projection")
+    if projection is None:
+        projection = cell["_projection"] = {
+            "cell_id": cell.get("cell_id"),
+            "code": cell.get("code"),
+            "outputs": cell.get("outputs"),
+            "error": cell.get("error"),
+        }
+    return projection
+
+
+def _invalidate_projection(cells_by_id: Optional[Dict[str, Dict]], cell_id) -> None:
+    cell = (cells_by_id or {}).get(cell_id)
+    if cell is not None:
+        cell.pop("_projection", None)
+
+
+def _read_cells(args: Dict[str, Any], cells_state: Optional[List[Dict]],
+                cells_by_id: Optional[Dict[str, Dict]]) -> Dict[str, Any]:
+    cell_id = args.get("cell_id")
+    if cell_id is not None:
+        # O(1) dict lookup instead of scanning the cell list
+        cell = (cells_by_id or {}).get(cell_id)
+        if cell is None:
+            return {"action": "read_cells", "error": f"Cell {cell_id} not found",
+                    "success": False}
+        return {"action": "read_cells", "cells": [_cell_projection(cell)], "success": True}
+    return {"action": "read_cells",
+            "cells": [_cell_projection(cell) for cell in (cells_state or [])],
+            "success": True}
+
+
+def _update_cell(args: Dict[str, Any], cells_state: Optional[List[Dict]],
+                 cells_by_id: Optional[Dict[str, Dict]]) -> Dict[str, Any]:
+    _invalidate_projection(cells_by_id, args.get("cell_id"))
+    return {"action": "update_cell", "cell_id": args.get("cell_id"),
+            "code": args.get("code"), "success": True}
+
+
+def _insert_cell(args: Dict[str, Any], cells_state: Optional[List[Dict]],
+                 cells_by_id: Optional[Dict[str, Dict]]) -> Dict[str, Any]:
+    return {"action": "insert_cell", "code": args.get("code"),
+            "index": args.get("index", -1), "success": True}
+
+
+def _delete_cell(args: Dict[str, Any], cells_state: Optional[List[Dict]],
+                 cells_by_id: Optional[Dict[str, Dict]]) -> Dict[str, Any]:
+    _invalidate_projection(cells_by_id, args.get("cell_id"))
+    return {"action": "delete_cell", "cell_id": args.get("cell_id"), "success": True}
+
+
+def _run_cell(args: Dict[str, Any], cells_state: Optional[List[Dict]],
+              cells_by_id: Optional[Dict[str, Dict]]) -> Dict[str, Any]:
+    # Running refreshes outputs/error, so any cached view is stale
+    _invalidate_projection(cells_by_id, args.get("cell_id"))
+    return {"action": "run_cell", "cell_id": args.get("cell_id"), "success": True}
+
+
+def _run_terminal_command(args: Dict[str, Any], cells_state: Optional[List[Dict]],
+                          cells_by_id: Optional[Dict[str, Dict]]) -> Dict[str, Any]:
+    return {"action": "run_terminal_command", "command": args.get("command"), "success": True}
+
+
+_TOOL_HANDLERS = {
+    "read_cells": _read_cells,
+    "update_cell": _update_cell,
+    "insert_cell": _insert_cell,
+    "delete_cell": _delete_cell,
+    "run_cell": _run_cell,
+    "run_terminal_command": _run_terminal_command,
+}
+
+# Coroutine handlers, consulted first by execute_tool_async. Empty for now:
+# run_terminal_command still returns an action stub because the frontend
+# executes it through /terminal/execute (running it here too would double-
+# execute), but any tool that moves server-side registers its coroutine here.
+_ASYNC_TOOL_HANDLERS: Dict[str, Any] = {}
+
+
+# Tool definitions are identical for every request, so build them once at
+# import instead of reallocating the dict trees per chat turn. Stored as a
+# tuple; the nested dicts stay plain so the OpenAI SDK can serialize them.
+_TOOL_DEFINITIONS = (
+    CellTool.read_cells(),
+    CellTool.update_cell(),
+    CellTool.insert_cell(),
+    CellTool.delete_cell(),
+    CellTool.run_cell(),
+    CellTool.run_terminal_command(),
+)
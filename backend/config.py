@@ -15,24 +15,58 @@ class Config:
     HOST = os.getenv("HOST", "0.0.0.0")
     
     # CORS Configuration
-    CORS_ORIGINS = [
+    CORS_ORIGINS = (
         "http://localhost:3000",
         "http://localhost:5173",
         "http://127.0.0.1:3000",
         "http://127.0.0.1:5173",
-    ]
+    )
     
     # Jupyter Configuration
     KERNEL_TIMEOUT = 60  # seconds
     EXECUTION_TIMEOUT = 300  # seconds
+    MAX_CONCURRENT_EXECUTIONS = 4  # executions in flight across all kernels
+
+    # Worker threads backing asyncio.to_thread / run_in_executor offloads
+    IO_THREADS = int(os.getenv("IO_THREADS", "16"))
+
+    # Requests with bodies above this are rejected with 413 before any
+    # JSON parsing; bounds worst-case memory per request
+    MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(64 * 1024 * 1024)))
     
     # AI Agent Configuration
     MAX_RETRY_ATTEMPTS = 3
+    MAX_CONCURRENT_LLM_CALLS = 8  # cap for fan-out requests (provider rate limits)
+    MAX_AGENT_CONCURRENCY = 4  # simultaneous /agent/* calls in flight per model
+
+    # Context budget: prompts are trimmed to roughly this many tokens
+    # (estimated at ~4 chars/token) before being sent to the model
+    MAX_CONTEXT_TOKENS = 8000
+    CONTEXT_FULL_CELL_NEIGHBORS = 3  # cells around the focus kept verbatim
+    MAX_TRACEBACK_LINES = 20  # longer tracebacks keep head + tail only
+
+    # Micro-batching for /agent/* endpoints: requests arriving within the
+    # latency window are dispatched together, per model
+    AGENT_BATCH_MAX_SIZE = 8
+    AGENT_BATCH_MAX_LATENCY_MS = 25
+
+    # Semantic response cache (repeated/near-identical debug prompts)
+    SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+    SEMANTIC_CACHE_SIZE = 256
+    SEMANTIC_CACHE_THRESHOLD = 0.95
+    EMBEDDING_MODEL = "text-embedding-3-small"
     
     # Model-specific configurations
-    # Reasoning models (o1-preview, o1-mini) use reasoning_effort instead of temperature
-    REASONING_MODELS = ["o1-preview", "o1-mini", "o1","gpt-5","gpt-5-mini","gpt-5-nano"]
+    # Reasoning models (o1-preview, o1-mini) use reasoning_effort instead of
+    # temperature. frozenset: O(1) membership tests and nothing can mutate it.
+    REASONING_MODELS = frozenset({"o1-preview", "o1-mini", "o1", "gpt-5", "gpt-5-mini", "gpt-5-nano"})
     
+    # Agents for these models are built at startup so the first request per
+    # model skips construction (comma-separated, overridable via env)
+    PRELOAD_MODELS = tuple(
+        m.strip() for m in os.getenv("PRELOAD_MODELS", "gpt-4o-mini").split(",") if m.strip()
+    )
+
     # Non-reasoning models use temperature
     DEFAULT_TEMPERATURE = 0.7
     DEFAULT_REASONING_EFFORT = "medium"  # low, medium, high
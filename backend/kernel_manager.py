@@ -2,10 +2,12 @@
 import asyncio
 import uuid
 from typing import Dict, List, Optional, Any
-from jupyter_client import KernelManager
+from jupyter_client import AsyncKernelManager
 import queue
 import logging
 
+from config import config
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,89 +16,140 @@ class NotebookKernel:
     
     def __init__(self, kernel_id: str):
         self.kernel_id = kernel_id
-        self.manager = KernelManager()
+        # AsyncKernelManager exposes coroutine APIs on top of zmq.asyncio,
+        # so no thread-pool hops are needed for kernel I/O
+        self.manager = AsyncKernelManager()
         self.client = None
         self.is_running = False
-        
+        # One execution at a time per kernel: concurrent execute requests
+        # would interleave iopub messages and misattribute outputs
+        self._exec_lock = asyncio.Lock()
+
     async def start(self):
         """Start the kernel."""
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self.manager.start_kernel)
+        await self.manager.start_kernel()
         self.client = self.manager.client()
         self.client.start_channels()
         self.is_running = True
         logger.info(f"Kernel {self.kernel_id} started")
-        
-    async def execute_cell(self, code: str, cell_id: str) -> Dict[str, Any]:
-        """Execute a cell and return results."""
+
+    async def iter_outputs(self, code: str, cell_id: str):
+        """
+        Execute a cell and yield output events as they arrive from iopub.
+
+        Events mirror the iopub message types: 'execute_input' (carries the
+        execution_count), 'execute_result', 'display_data', 'stream' and
+        'error'. Streaming consumers (the /execute/ws endpoint) forward each
+        event immediately; buffered consumers accumulate them.
+        """
         if not self.is_running:
             raise RuntimeError("Kernel is not running")
-        
-        loop = asyncio.get_event_loop()
-        
-        # Execute code
-        msg_id = await loop.run_in_executor(
-            None, 
-            self.client.execute, 
-            code
-        )
-        
-        # Collect outputs
-        outputs = []
-        error = None
-        execution_count = None
-        
+
+        async with self._exec_lock:
+            async for event in self._iter_outputs_locked(code, cell_id):
+                yield event
+
+    async def _iter_outputs_locked(self, code: str, cell_id: str):
+        # Execute code (send is non-blocking)
+        msg_id = self.client.execute(code)
+
+        # Once the first message arrives, drain whatever else is already
+        # queued with timeout=0 before waiting again: chatty cells (tight
+        # print loops, progress bars) deliver bursts of stream messages and
+        # a 10s poll per message would serialize them needlessly.
+        timeout = 10
         while True:
             try:
-                msg = await loop.run_in_executor(
-                    None,
-                    self.client.get_iopub_msg,
-                    10  # timeout
-                )
-                
+                msg = await self.client.get_iopub_msg(timeout=timeout)
+                timeout = 0
+
                 msg_type = msg['msg_type']
                 content = msg['content']
-                
+
                 if msg_type == 'execute_input':
-                    execution_count = content.get('execution_count')
-                    
+                    yield {
+                        'type': 'execute_input',
+                        'execution_count': content.get('execution_count')
+                    }
+
                 elif msg_type == 'execute_result':
-                    outputs.append({
+                    yield {
                         'type': 'execute_result',
                         'data': content.get('data', {}),
                         'execution_count': content.get('execution_count')
-                    })
-                    
+                    }
+
                 elif msg_type == 'display_data':
-                    outputs.append({
+                    yield {
                         'type': 'display_data',
                         'data': content.get('data', {})
-                    })
-                    
+                    }
+
                 elif msg_type == 'stream':
-                    outputs.append({
+                    yield {
                         'type': 'stream',
                         'name': content.get('name'),
-                        'text': content.get('text')
-                    })
-                    
+                        'text': content.get('text', '')
+                    }
+
                 elif msg_type == 'error':
-                    error = {
+                    yield {
+                        'type': 'error',
                         'ename': content.get('ename'),
                         'evalue': content.get('evalue'),
                         'traceback': content.get('traceback', [])
                     }
-                    
+
                 elif msg_type == 'status':
                     if content.get('execution_state') == 'idle':
                         break
-                        
+
             except queue.Empty:
+                if timeout == 0:
+                    # Burst drained; go back to a real wait for the next one
+                    timeout = 10
+                    continue
                 break
             except Exception as e:
                 logger.error(f"Error getting message: {e}")
                 break
-        
+
+    async def execute_cell(self, code: str, cell_id: str) -> Dict[str, Any]:
+        """Execute a cell and return the buffered results."""
+        outputs = []
+        error = None
+        execution_count = None
+        # One output dict per stream name, placed where the stream first
+        # appeared; chunks collect in a list and are joined once at the end.
+        # Repeated str += over millions of print chunks is quadratic, and a
+        # dict per chunk costs ~240B of object overhead each.
+        stream_buffers: Dict[str, tuple] = {}
+
+        async for event in self.iter_outputs(code, cell_id):
+            event_type = event['type']
+            if event_type == 'execute_input':
+                execution_count = event.get('execution_count')
+            elif event_type == 'error':
+                error = {
+                    'ename': event.get('ename'),
+                    'evalue': event.get('evalue'),
+                    'traceback': event.get('traceback', [])
+                }
+            elif event_type == 'stream':
+                name = event['name']
+                buffered = stream_buffers.get(name)
+                if buffered is None:
+                    placeholder = {'type': 'stream', 'name': name, 'text': ''}
+                    outputs.append(placeholder)
+                    stream_buffers[name] = (placeholder, [event['text']])
+                else:
+                    buffered[1].append(event['text'])
+            else:
+                outputs.append(event)
+
+        for placeholder, chunks in stream_buffers.values():
+            placeholder['text'] = ''.join(chunks)
+
         return {
             'cell_id': cell_id,
             'execution_count': execution_count,
@@ -107,39 +160,67 @@ class NotebookKernel:
     
     async def interrupt(self):
         """Interrupt the kernel."""
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self.manager.interrupt_kernel)
+        await self.manager.interrupt_kernel()
         logger.info(f"Kernel {self.kernel_id} interrupted")
-        
+
     async def restart(self):
         """Restart the kernel."""
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self.manager.restart_kernel)
+        await self.manager.restart_kernel()
         logger.info(f"Kernel {self.kernel_id} restarted")
-        
+
     async def shutdown(self):
         """Shutdown the kernel."""
         if self.client:
             self.client.stop_channels()
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self.manager.shutdown_kernel)
+        await self.manager.shutdown_kernel()
         self.is_running = False
         logger.info(f"Kernel {self.kernel_id} shutdown")
 
 
 class KernelManagerService:
     """Manages multiple kernel instances."""
-    
+
+    # Pre-started idle kernels handed out by create_kernel. Kernel startup
+    # (spawning the process, initializing IPython) takes 1-3s and dominates
+    # first-request latency, so it runs off the request path.
+    WARM_POOL_SIZE = 2
+
     def __init__(self):
         self.kernels: Dict[str, NotebookKernel] = {}
-        
+        self._warm: asyncio.Queue = asyncio.Queue(maxsize=self.WARM_POOL_SIZE)
+        # Backpressure across kernels: queued executions wait here instead
+        # of piling onto the kernels all at once
+        self._global_sem = asyncio.Semaphore(config.MAX_CONCURRENT_EXECUTIONS)
+
+    async def _refill(self):
+        """Start one kernel and park it in the warm pool."""
+        try:
+            kernel = NotebookKernel(str(uuid.uuid4()))
+            await kernel.start()
+            try:
+                self._warm.put_nowait(kernel)
+            except asyncio.QueueFull:
+                await kernel.shutdown()
+        except Exception as e:
+            logger.error(f"Error pre-warming kernel: {e}")
+
+    async def prewarm(self):
+        """Fill the warm pool; called once from app startup."""
+        missing = self.WARM_POOL_SIZE - self._warm.qsize()
+        if missing > 0:
+            await asyncio.gather(*(self._refill() for _ in range(missing)))
+
     async def create_kernel(self) -> str:
         """Create a new kernel and return its ID."""
-        kernel_id = str(uuid.uuid4())
-        kernel = NotebookKernel(kernel_id)
-        await kernel.start()
-        self.kernels[kernel_id] = kernel
-        return kernel_id
+        try:
+            kernel = self._warm.get_nowait()
+        except asyncio.QueueEmpty:
+            # Pool exhausted (or never warmed): cold start as before
+            kernel = NotebookKernel(str(uuid.uuid4()))
+            await kernel.start()
+        asyncio.get_running_loop().create_task(self._refill())
+        self.kernels[kernel.kernel_id] = kernel
+        return kernel.kernel_id
     
     def get_kernel(self, kernel_id: str) -> Optional[NotebookKernel]:
         """Get a kernel by ID."""
@@ -165,12 +246,19 @@ class KernelManagerService:
         kernel = self.kernels.get(kernel_id)
         if not kernel:
             raise ValueError(f"Kernel {kernel_id} not found")
-        return await kernel.execute_cell(code, cell_id)
+        async with self._global_sem:
+            return await kernel.execute_cell(code, cell_id)
 
     async def shutdown_all(self):
-        """Shutdown all kernels."""
+        """Shutdown all kernels, including pre-warmed idle ones."""
         for kernel_id in list(self.kernels.keys()):
             await self.shutdown_kernel(kernel_id)
+        while True:
+            try:
+                kernel = self._warm.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            await kernel.shutdown()
 
 
 # Global kernel manager instance
@@ -1,17 +1,19 @@
 import os
 import logging
 import asyncio
-import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import nbformat
+from starlette.middleware.base import BaseHTTPMiddleware
 
 from config import config
 from kernel_manager import kernel_manager
-from ai_agent import agent_service, NotebookCell
 from models import (
     CreateKernelResponse,
     ExecuteCellRequest,
@@ -26,7 +28,8 @@ from models import (
     SaveNotebookRequest,
     LoadNotebookResponse,
     ChatRequest,
-    ChatResponse
+    ChatResponse,
+    BatchExecuteRequest
 )
 from pydantic import BaseModel
 
@@ -34,7 +37,15 @@ from pydantic import BaseModel
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Jupyter Agent API")
+# Resolved and created once at import; handlers were paying a mkdir/stat
+# syscall pair per request just to rebuild this path
+NOTEBOOKS_DIR = Path("notebooks").resolve()
+NOTEBOOKS_DIR.mkdir(exist_ok=True)
+
+# orjson serializes responses several times faster than stdlib json and
+# emits bytes directly; notebook payloads (base64 images, DataFrame HTML)
+# are where it pays off
+app = FastAPI(title="Jupyter Agent API", default_response_class=ORJSONResponse)
 
 # Configure CORS
 app.add_middleware(
@@ -45,6 +56,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Notebook JSON (repeated keys, base64 images) compresses very well;
+# level 5 keeps CPU cost modest and small responses skip gzip entirely.
+# Streaming responses (SSE, NDJSON) opt out by setting Content-Encoding
+# themselves - gzip would buffer their incremental chunks until close.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+class BodySizeLimitMiddleware(BaseHTTPMiddleware):
+    """
+    Reject oversized request bodies before any JSON parsing happens.
+
+    Nothing bounds cells payloads otherwise; pydantic would walk an
+    arbitrarily large notebook on the event loop and blow up worker
+    memory. Declared sizes above MAX_BODY_BYTES get an immediate 413.
+    """
+
+    async def dispatch(self, request, call_next):
+        content_length = request.headers.get("content-length")
+        if content_length is not None:
+            try:
+                if int(content_length) > config.MAX_BODY_BYTES:
+                    return Response(status_code=413, content="Request body too large")
+            except ValueError:
+                pass  # malformed header; let the server reject it downstream
+        return await call_next(request)
+
+
+# Added last so it runs outermost: oversized requests are turned away
+# before CORS or compression do any work
+app.add_middleware(BodySizeLimitMiddleware)
+
+# The agent and execute endpoints return dicts the backend itself produced;
+# rebuilding response models from them just re-validates known-good data.
+# They declare the model under responses= for OpenAPI and hand the dict
+# straight to ORJSONResponse.
+
 # ==================== Kernel Management Endpoints ====================
 
 @app.post("/kernel/create", response_model=CreateKernelResponse)
@@ -67,7 +114,7 @@ async def restart_kernel(kernel_id: str):
         logger.error(f"Error restarting kernel: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/execute", response_model=ExecuteCellResponse)
+@app.post("/execute", responses={200: {"model": ExecuteCellResponse}})
 async def execute_cell(request: ExecuteCellRequest):
     """Execute a code cell in a specific kernel."""
     try:
@@ -76,132 +123,264 @@ async def execute_cell(request: ExecuteCellRequest):
             request.code,
             request.cell_id
         )
-        return ExecuteCellResponse(**result)
+        return ORJSONResponse(result)
     except Exception as e:
         logger.error(f"Error executing cell: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.websocket("/execute/ws")
+async def execute_cell_ws(websocket: WebSocket):
+    """
+    Execute a code cell and stream outputs as they arrive.
+
+    The client sends one JSON message ({kernel_id, code, cell_id}) and
+    receives each output event the moment the kernel emits it, instead of
+    waiting for the cell to finish. A final {"type": "done"} marks idle.
+    """
+    await websocket.accept()
+    try:
+        request = await websocket.receive_json()
+        kernel = kernel_manager.get_kernel(request["kernel_id"])
+        if kernel is None:
+            await websocket.send_json({
+                "type": "error",
+                "ename": "KernelNotFound",
+                "evalue": f"Kernel {request['kernel_id']} not found",
+                "traceback": []
+            })
+        else:
+            async for event in kernel.iter_outputs(request["code"], request.get("cell_id", "")):
+                await websocket.send_json(event)
+        await websocket.send_json({"type": "done"})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Error in execute websocket: {e}")
+    finally:
+        try:
+            await websocket.close()
+        except RuntimeError:
+            pass  # already closed by the client
+
+@app.post("/execute/batch")
+async def execute_cells_batch(request: BatchExecuteRequest):
+    """
+    Execute several cells on one kernel and stream results as NDJSON.
+
+    Running a notebook cell by cell over N /execute posts pays HTTP and
+    scheduling overhead per cell; here the cells run back to back on the
+    kernel and each result is written as one JSON line the moment its
+    cell finishes, so the client can render progressively.
+    """
+    import orjson
+
+    async def result_stream():
+        for cell in request.cells:
+            try:
+                result = await kernel_manager.execute_cell(
+                    request.kernel_id,
+                    cell.code,
+                    cell.cell_id
+                )
+            except Exception as e:
+                logger.error(f"Error executing cell {cell.cell_id} in batch: {e}")
+                yield orjson.dumps({
+                    "cell_id": cell.cell_id,
+                    "execution_count": None,
+                    "outputs": [],
+                    "error": {"ename": type(e).__name__, "evalue": str(e), "traceback": []},
+                    "status": "error"
+                }) + b"\n"
+                break  # a missing/dead kernel fails every later cell too
+            yield orjson.dumps(result) + b"\n"
+
+    # An explicit Content-Encoding makes GZipMiddleware pass the response
+    # through untouched; compressed, each NDJSON line would sit in zlib's
+    # buffer until the stream closed, losing the progressive delivery
+    return StreamingResponse(
+        result_stream(),
+        media_type="application/x-ndjson",
+        headers={"Content-Encoding": "identity"},
+    )
+
 # ==================== AI Agent Endpoints ====================
 
-@app.post("/agent/analyze-error", response_model=AnalyzeErrorResponse)
+# One semaphore per model bounds how many agent calls are in flight at
+# once; bursts queue here instead of stacking onto the provider and
+# coming back as 429 retries
+_agent_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _agent_semaphore(model_name: Optional[str]) -> asyncio.Semaphore:
+    return _agent_semaphores.setdefault(
+        model_name or "default",
+        asyncio.Semaphore(config.MAX_AGENT_CONCURRENCY)
+    )
+
+
+@app.post("/agent/analyze-error", responses={200: {"model": AnalyzeErrorResponse}})
 async def analyze_error(request: AnalyzeErrorRequest):
     """Analyze an error in a notebook cell."""
     try:
-        # Convert to NotebookCell objects
-        cells = [
-            NotebookCell(
-                cell_id=cell.cell_id,
-                code=cell.code,
-                execution_count=cell.execution_count,
-                outputs=cell.outputs,
-                error=cell.error
-            )
-            for cell in request.cells
-        ]
-        
+        from ai_agent import agent_service, agent_batcher, NotebookCell
+
+        cells = NotebookCell.from_models(request.cells)
+
         # Get agent
         agent = agent_service.get_agent(request.model_name)
         
         # Analyze error
-        result = await agent.analyze_error(cells, request.error_cell_id)
+        async with _agent_semaphore(request.model_name):
+            result = await agent_batcher.submit(
+                request.model_name,
+                lambda: agent.analyze_error(cells, request.error_cell_id)
+            )
         
-        return AnalyzeErrorResponse(**result)
+        return ORJSONResponse(result)
     except Exception as e:
         logger.error(f"Error analyzing error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/agent/generate-code", response_model=GenerateCodeResponse)
+@app.post("/agent/generate-code", responses={200: {"model": GenerateCodeResponse}})
 async def generate_code(request: GenerateCodeRequest):
     """Generate code based on user request and notebook context."""
     try:
-        # Convert to NotebookCell objects
-        cells = [
-            NotebookCell(
-                cell_id=cell.cell_id,
-                code=cell.code,
-                execution_count=cell.execution_count,
-                outputs=cell.outputs,
-                error=cell.error
-            )
-            for cell in request.cells
-        ]
-        
+        from ai_agent import agent_service, agent_batcher, NotebookCell
+
+        cells = NotebookCell.from_models(request.cells)
+
         # Get agent
         agent = agent_service.get_agent(request.model_name)
         
         # Generate code
-        result = await agent.suggest_code(cells, request.user_request)
+        async with _agent_semaphore(request.model_name):
+            result = await agent_batcher.submit(
+                request.model_name,
+                lambda: agent.suggest_code(cells, request.user_request)
+            )
         
-        return GenerateCodeResponse(**result)
+        return ORJSONResponse(result)
     except Exception as e:
         logger.error(f"Error generating code: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/agent/optimize", response_model=OptimizeNotebookResponse)
+@app.post("/agent/optimize", responses={200: {"model": OptimizeNotebookResponse}})
 async def optimize_notebook(request: OptimizeNotebookRequest):
     """Get optimization suggestions for the entire notebook."""
     try:
-        # Convert to NotebookCell objects
-        cells = [
-            NotebookCell(
-                cell_id=cell.cell_id,
-                code=cell.code,
-                execution_count=cell.execution_count,
-                outputs=cell.outputs,
-                error=cell.error
-            )
-            for cell in request.cells
-        ]
-        
+        from ai_agent import agent_service, agent_batcher, NotebookCell
+
+        cells = NotebookCell.from_models(request.cells)
+
         # Get agent
         agent = agent_service.get_agent(request.model_name)
         
         # Optimize
-        result = await agent.optimize_notebook(cells)
+        async with _agent_semaphore(request.model_name):
+            result = await agent_batcher.submit(
+                request.model_name,
+                lambda: agent.optimize_notebook(cells)
+            )
         
-        return OptimizeNotebookResponse(**result)
+        return ORJSONResponse(result)
     except Exception as e:
         logger.error(f"Error optimizing notebook: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/agent/chat", response_model=ChatResponse)
+@app.post("/agent/chat", responses={200: {"model": ChatResponse}})
 async def chat_with_agent(request: ChatRequest):
     """
     Chat with AI agent - Cursor-like experience!
     The agent can directly manipulate cells through conversation.
     """
     try:
-        # Convert to NotebookCell objects
-        cells = [
-            NotebookCell(
-                cell_id=cell.cell_id,
-                code=cell.code,
-                execution_count=cell.execution_count,
-                outputs=cell.outputs,
-                error=cell.error
-            )
-            for cell in request.cells
-        ]
-        
+        from ai_agent import agent_service, agent_batcher, NotebookCell
+
+        cells = NotebookCell.from_models(request.cells)
+
         # Get agent
         agent = agent_service.get_agent(request.model_name)
         
         # Chat
-        result = await agent.chat(cells, request.user_message, request.conversation_history)
+        async with _agent_semaphore(request.model_name):
+            result = await agent_batcher.submit(
+                request.model_name,
+                lambda: agent.chat(cells, request.user_message, request.conversation_history)
+            )
         
-        return ChatResponse(**result)
+        return ORJSONResponse(result)
     except Exception as e:
         logger.error(f"Error in chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# nbformat reads/writes are blocking file I/O plus JSON (de)serialization;
+# they run in worker threads via asyncio.to_thread so a multi-megabyte
+# notebook never stalls the event loop
+def _write_notebook_file(nb, filepath: Path) -> None:
+    import nbformat
+    # Serialize once and write in a single call: nbformat.write against a
+    # default-buffered file issues thousands of small write() syscalls for
+    # output-heavy notebooks
+    data = nbformat.writes(nb)
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(data)
+
+
+def _read_notebook_file(filepath: Path):
+    import nbformat
+    # 1MB buffer keeps read() syscalls rare for multi-megabyte notebooks
+    with open(filepath, 'r', encoding='utf-8', buffering=1 << 20) as f:
+        return nbformat.read(f, as_version=4)
+
+
+@app.post("/agent/chat/stream")
+async def chat_with_agent_stream(request: ChatRequest):
+    """
+    Chat with the AI agent, streaming the reply as Server-Sent Events.
+
+    Tokens reach the client as the provider produces them, so perceived
+    latency is time-to-first-token instead of full-completion time and the
+    server holds only one chunk at a time. Tool calls need the complete
+    response, so this path answers conversationally without tools; use
+    /agent/chat when cell manipulation is required.
+    """
+    import json
+
+    from ai_agent import agent_service, NotebookCell
+
+    cells = NotebookCell.from_models(request.cells)
+    agent = agent_service.get_agent(request.model_name)
+
+    async def event_stream():
+        try:
+            async for chunk in agent.chat_stream(
+                cells, request.user_message, request.conversation_history
+            ):
+                yield f"data: {json.dumps({'delta': chunk})}\n\n"
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            logger.error(f"Error in chat stream: {e}")
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+    # Content-Encoding: identity exempts the stream from GZipMiddleware,
+    # which would otherwise buffer the token-sized SSE frames to the end
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Content-Encoding": "identity"},
+    )
+
+
 @app.post("/notebook/save")
 async def save_notebook(request: SaveNotebookRequest):
     """Save notebook to .ipynb file."""
     try:
+        import nbformat
+
         # Create notebook
         nb = nbformat.v4.new_notebook()
         
@@ -217,13 +396,10 @@ async def save_notebook(request: SaveNotebookRequest):
             nb.cells.append(nb_cell)
         
         # Save to file
-        notebooks_dir = Path("notebooks")
-        notebooks_dir.mkdir(exist_ok=True)
-        
-        filepath = notebooks_dir / request.filename
-        with open(filepath, 'w', encoding='utf-8') as f:
-            nbformat.write(nb, f)
-        
+        filepath = NOTEBOOKS_DIR / request.filename
+        await asyncio.to_thread(_write_notebook_file, nb, filepath)
+        _NB_LIST_CACHE["dir_mtime"] = None  # force a rescan on the next list
+
         return {"status": "saved", "filename": request.filename}
     except Exception as e:
         logger.error(f"Error saving notebook: {e}")
@@ -231,32 +407,64 @@ async def save_notebook(request: SaveNotebookRequest):
 
 
 
+# Parsed notebooks keyed by (path, mtime, size): repeated loads of an
+# unchanged file skip the read + nbformat parse entirely, and the key
+# invalidates itself the moment the file changes on disk
+_NB_CACHE: "OrderedDict[tuple, LoadNotebookResponse]" = OrderedDict()
+_NB_CACHE_MAX = 32
+
+
 @app.get("/notebook/load/{filename}", response_model=LoadNotebookResponse)
-async def load_notebook(filename: str):
-    """Load notebook from .ipynb file."""
+async def load_notebook(filename: str, raw: bool = False):
+    """
+    Load notebook from .ipynb file.
+
+    With ?raw=1 the file is sent as-is via FileResponse — no nbformat
+    parse, no model rebuild, no re-serialization; the kernel can
+    sendfile() it disk-to-socket. The default (parsed) mode returns the
+    cell list the frontend works with.
+    """
     try:
-        filepath = Path("notebooks") / filename
-        
-        if not filepath.exists():
+        filepath = NOTEBOOKS_DIR / filename
+
+        try:
+            stat = filepath.stat()
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="Notebook not found")
-        
+
+        if raw:
+            return FileResponse(filepath, media_type='application/json', filename=filename)
+
+        cache_key = (str(filepath), stat.st_mtime, stat.st_size)
+        cached = _NB_CACHE.get(cache_key)
+        if cached is not None:
+            _NB_CACHE.move_to_end(cache_key)
+            return cached
+
         # Load notebook
-        with open(filepath, 'r', encoding='utf-8') as f:
-            nb = nbformat.read(f, as_version=4)
-        
-        # Convert to our format
+        nb = await asyncio.to_thread(_read_notebook_file, filepath)
+
+        # Convert to our format. nbformat has already validated the file
+        # against the notebook schema, so model_construct skips pydantic's
+        # per-field re-validation (the expensive part for output-heavy cells)
         cells = []
         for i, cell in enumerate(nb.cells):
-            cell_model = NotebookCellModel(
+            cell_model = NotebookCellModel.model_construct(
                 cell_id=f"cell-{i}",
                 code=cell.source,
                 cell_type=cell.cell_type,
                 execution_count=getattr(cell, 'execution_count', None),
-                outputs=[output for output in getattr(cell, 'outputs', [])]
+                # Outputs are serialized straight out, never mutated, so the
+                # nbformat list is referenced directly instead of copied
+                outputs=getattr(cell, 'outputs', None) or []
             )
             cells.append(cell_model)
-        
-        return LoadNotebookResponse(filename=filename, cells=cells)
+
+        response = LoadNotebookResponse(filename=filename, cells=cells)
+        _NB_CACHE[cache_key] = response
+        if len(_NB_CACHE) > _NB_CACHE_MAX:
+            _NB_CACHE.popitem(last=False)
+        return response
     except HTTPException:
         raise
     except Exception as e:
@@ -264,33 +472,90 @@ async def load_notebook(filename: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Listing cache keyed by the directory's mtime: adding, removing or
+# rewriting a notebook bumps it, so the scan burst runs only when the
+# directory actually changed. save_notebook clears the key explicitly to
+# cover filesystems with coarse mtime granularity.
+_NB_LIST_CACHE: Dict[str, Any] = {"dir_mtime": None, "value": None}
+
+
+def _scan_notebooks_dir() -> List[Dict[str, Any]]:
+    # scandir returns metadata with the directory listing and DirEntry
+    # caches the stat result, so this is one syscall per file instead
+    # of three (glob + two stat calls)
+    notebooks = []
+    with os.scandir(NOTEBOOKS_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".ipynb") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            notebooks.append({
+                "filename": entry.name,
+                "size": stat.st_size,
+                "modified": stat.st_mtime
+            })
+    return notebooks
+
+
 @app.get("/notebook/list")
 async def list_notebooks():
     """List all saved notebooks."""
     try:
-        notebooks_dir = Path("notebooks")
-        notebooks_dir.mkdir(exist_ok=True)
-        
-        notebooks = [
-            {
-                "filename": f.name,
-                "size": f.stat().st_size,
-                "modified": f.stat().st_mtime
-            }
-            for f in notebooks_dir.glob("*.ipynb")
-        ]
-        
+        dir_mtime = NOTEBOOKS_DIR.stat().st_mtime
+        if dir_mtime == _NB_LIST_CACHE["dir_mtime"]:
+            return {"notebooks": _NB_LIST_CACHE["value"]}
+
+        # Directory scans are still syscalls; on a big notebooks dir (or a
+        # network filesystem) they belong in a worker thread like the rest
+        # of the file I/O
+        notebooks = await asyncio.to_thread(_scan_notebooks_dir)
+        _NB_LIST_CACHE["dir_mtime"] = dir_mtime
+        _NB_LIST_CACHE["value"] = notebooks
         return {"notebooks": notebooks}
     except Exception as e:
         logger.error(f"Error listing notebooks: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# All to_thread / run_in_executor offloads (notebook I/O, directory scans)
+# share this pool, so its size caps blocking-work concurrency and memory
+# stays predictable; created at startup, installed as the loop default
+_io_executor: Optional[ThreadPoolExecutor] = None
+
+
+@app.on_event("startup")
+async def startup_event():
+    """Install the shared I/O executor and warm the kernel pool."""
+    global _io_executor
+    _io_executor = ThreadPoolExecutor(
+        max_workers=config.IO_THREADS,
+        thread_name_prefix="jup-io"
+    )
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(_io_executor)
+    loop.create_task(kernel_manager.prewarm())
+
+    # Build the configured agents now so the first request per model is a
+    # dict lookup instead of paying client construction and model probing
+    if config.PRELOAD_MODELS:
+        from ai_agent import agent_service
+        for model_name in config.PRELOAD_MODELS:
+            agent_service.get_agent(model_name)
+
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown."""
     logger.info("Shutting down, cleaning up kernels...")
     await kernel_manager.shutdown_all()
+    # Only close the shared HTTP client if an agent endpoint actually
+    # loaded the module; importing it here just to close it would undo
+    # the lazy-import saving
+    import sys
+    if "ai_agent" in sys.modules:
+        await sys.modules["ai_agent"].aclose_http_client()
+    if _io_executor is not None:
+        _io_executor.shutdown(wait=False, cancel_futures=True)
 
 # ==================== Terminal Endpoints ====================
 
@@ -303,30 +568,40 @@ async def execute_terminal_command(request: TerminalCommandRequest):
     Execute a shell command and return the output.
     """
     try:
-        # Use subprocess to run the command
-        # shell=True allows using shell features like pipes and redirects, but be careful with input
-        # Since this is a local dev tool, we assume the user (via agent) is authorized
-        process = subprocess.run(
+        # shell=True semantics (pipes, redirects) are preserved by
+        # create_subprocess_shell, but the event loop keeps serving other
+        # requests while the command runs instead of blocking on it.
+        # Since this is a local dev tool, we assume the user (via agent)
+        # is authorized; EXECUTION_TIMEOUT bounds runaway commands.
+        from cell_tools import CellTool
+
+        result = await CellTool.run_shell_command(
             request.command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            cwd=os.getcwd() # Execute in project root
+            timeout=config.EXECUTION_TIMEOUT
         )
-        
+
         return {
-            "stdout": process.stdout,
-            "stderr": process.stderr,
-            "returncode": process.returncode
+            "stdout": result["stdout"],
+            "stderr": result["stderr"],
+            "returncode": result["returncode"]
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
+
+    # libuv event loop + C HTTP parser; both are POSIX-only, so Windows
+    # (setup.ps1 users) keeps uvicorn's defaults
+    server_opts = {}
+    if sys.platform != "win32":
+        server_opts = {"loop": "uvloop", "http": "httptools"}
+
     uvicorn.run(
         "main:app",
         host=config.HOST,
         port=config.PORT,
-        reload=True
+        reload=True,
+        **server_opts
     )
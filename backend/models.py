@@ -1,9 +1,21 @@
 """Pydantic models for API requests and responses."""
 from typing import List, Optional, Dict, Any
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, SkipValidation
 
 
-class CellOutput(BaseModel):
+class APIModel(BaseModel):
+    """
+    Shared base for all API models.
+
+    extra='ignore' drops unknown keys instead of validating and storing
+    them (cheaper for output-heavy payloads from evolving frontends), and
+    clearing protected_namespaces lets the model_name fields exist without
+    pydantic's model_ namespace warning.
+    """
+    model_config = ConfigDict(extra='ignore', protected_namespaces=())
+
+
+class CellOutput(APIModel):
     """Output from a cell execution."""
     type: str
     data: Optional[Dict[str, Any]] = None
@@ -12,31 +24,35 @@ class CellOutput(BaseModel):
     execution_count: Optional[int] = None
 
 
-class CellError(BaseModel):
+class CellError(APIModel):
     """Error from a cell execution."""
     ename: str
     evalue: str
     traceback: List[str]
 
 
-class NotebookCellModel(BaseModel):
+class NotebookCellModel(APIModel):
     """Model for a notebook cell."""
     cell_id: str
     code: str
     cell_type: str = "code"
     execution_count: Optional[int] = None
-    outputs: List[Dict[str, Any]] = []
+    # Outputs are opaque pass-through data (base64 images, HTML tables);
+    # walking them dict by dict is the single most expensive part of
+    # validating a large notebook, and nothing downstream relies on their
+    # shape, so validation is skipped
+    outputs: SkipValidation[List[Dict[str, Any]]] = []
     error: Optional[Dict[str, Any]] = None
 
 
-class ExecuteCellRequest(BaseModel):
+class ExecuteCellRequest(APIModel):
     """Request to execute a cell."""
     kernel_id: str
     cell_id: str
     code: str
 
 
-class ExecuteCellResponse(BaseModel):
+class ExecuteCellResponse(APIModel):
     """Response from cell execution."""
     cell_id: str
     execution_count: Optional[int]
@@ -45,20 +61,32 @@ class ExecuteCellResponse(BaseModel):
     status: str
 
 
-class CreateKernelResponse(BaseModel):
+class BatchCellRequest(APIModel):
+    """A single cell within a batch execution request."""
+    cell_id: str
+    code: str
+
+
+class BatchExecuteRequest(APIModel):
+    """Request to execute several cells on one kernel, in order."""
+    kernel_id: str
+    cells: List[BatchCellRequest]
+
+
+class CreateKernelResponse(APIModel):
     """Response when creating a kernel."""
     kernel_id: str
     status: str
 
 
-class AnalyzeErrorRequest(BaseModel):
+class AnalyzeErrorRequest(APIModel):
     """Request to analyze an error."""
     cells: List[NotebookCellModel]
     error_cell_id: str
     model_name: Optional[str] = None
 
 
-class AnalyzeErrorResponse(BaseModel):
+class AnalyzeErrorResponse(APIModel):
     """Response from error analysis."""
     analysis: str
     cells_to_fix: List[str]
@@ -68,14 +96,14 @@ class AnalyzeErrorResponse(BaseModel):
     explanation: str
 
 
-class GenerateCodeRequest(BaseModel):
+class GenerateCodeRequest(APIModel):
     """Request to generate code."""
     cells: List[NotebookCellModel]
     user_request: str
     model_name: Optional[str] = None
 
 
-class GenerateCodeResponse(BaseModel):
+class GenerateCodeResponse(APIModel):
     """Response with generated code."""
     code: str
     explanation: str
@@ -83,13 +111,13 @@ class GenerateCodeResponse(BaseModel):
     dependencies: List[str] = []
 
 
-class OptimizeNotebookRequest(BaseModel):
+class OptimizeNotebookRequest(APIModel):
     """Request to optimize notebook."""
     cells: List[NotebookCellModel]
     model_name: Optional[str] = None
 
 
-class Suggestion(BaseModel):
+class Suggestion(APIModel):
     """A single optimization suggestion."""
     cell_id: str
     issue: str
@@ -97,33 +125,34 @@ class Suggestion(BaseModel):
     priority: str
 
 
-class OptimizeNotebookResponse(BaseModel):
+class OptimizeNotebookResponse(APIModel):
     """Response with optimization suggestions."""
     suggestions: List[Suggestion]
     overall_assessment: str
 
 
-class SaveNotebookRequest(BaseModel):
+class SaveNotebookRequest(APIModel):
     """Request to save notebook."""
     filename: str
     cells: List[NotebookCellModel]
 
 
-class LoadNotebookResponse(BaseModel):
+class LoadNotebookResponse(APIModel):
     """Response when loading notebook."""
     filename: str
     cells: List[NotebookCellModel]
 
 
-class ChatRequest(BaseModel):
+class ChatRequest(APIModel):
     """Request to chat with AI agent."""
     cells: List[NotebookCellModel]
     user_message: str
-    conversation_history: Optional[List[Dict[str, Any]]] = None
+    # Prior turns round-trip between frontend and provider untouched
+    conversation_history: SkipValidation[Optional[List[Dict[str, Any]]]] = None
     model_name: Optional[str] = None
 
 
-class ToolCall(BaseModel):
+class ToolCall(APIModel):
     """A tool call made by the agent."""
     id: str
     name: str
@@ -131,7 +160,7 @@ class ToolCall(BaseModel):
     result: Dict[str, Any]
 
 
-class ChatResponse(BaseModel):
+class ChatResponse(APIModel):
     """Response from chat."""
     message: str
     tool_calls: List[ToolCall] = []